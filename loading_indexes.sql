@@ -0,0 +1,6 @@
+-- Indexes for the bulk-loaded tables, created after the data is loaded
+
+CREATE INDEX ON maniphest_transaction (task_id, date_modified, has_edge_data);
+
+CREATE INDEX ON maniphest_blocked_phid (blocks_phid);
+CREATE INDEX ON maniphest_blocked_phid (blocked_by_phid);
@@ -39,8 +39,6 @@ CREATE TABLE maniphest_transaction (
        active_projects int array
 );
 
-CREATE INDEX ON maniphest_transaction (task_id, date_modified, has_edge_data);
-
 -- No RI for this table because otherwise we would have to load all
 -- tasks before any blocks
 DROP TABLE IF EXISTS maniphest_blocked_phid;
@@ -51,9 +49,6 @@ CREATE TABLE maniphest_blocked_phid (
        blocked_by_phid text
 );
 
-CREATE INDEX ON maniphest_blocked_phid (blocks_phid);
-CREATE INDEX ON maniphest_blocked_phid (blocked_by_phid);
-
 CREATE TABLE maniphest_blocked (
        blocked_date date,
        parent_id int references maniphest_task (id),
@@ -1,21 +1,82 @@
 #!/usr/bin/python3
 
-import bisect
+import collections
+import concurrent.futures
 import configparser
 import csv
 import datetime
 from dateutil import relativedelta as rd
+import functools
+import io
+import itertools
 import json
 import os.path
 import psycopg2
+import psycopg2.pool
 import sys
 import pytz
 import getopt
+import glob
+import re
+import shlex
+import shutil
 import subprocess
-import time
 
 from jinja2 import Template
 
+try:
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    import ijson
+
+# Number of rows buffered in memory before being sent to the database
+# with COPY
+COPY_BATCH_SIZE = 50000
+
+# Upper bound on the extra database connections reconstruct() opens to
+# work on several days at once.  Kept small because other scopes may be
+# reconstructing against the same server at the same time.
+MAX_RECONSTRUCT_CONNECTIONS = 4
+
+# Matches a psql script COPY statement that writes to a server-side file
+COPY_TO_FILE_RE = re.compile(r"^(COPY\s*\(.*\))\s*TO\s+'([^']+)'(.*)$",
+                             re.DOTALL | re.IGNORECASE)
+
+# ColorBrewer Set3, as returned by RColorBrewer's brewer.pal(12, "Set3").
+# Categories beyond the end of the palette are drawn in grey.
+CATEGORY_PALETTE = ('#8DD3C7', '#FFFFB3', '#BEBADA', '#FB8072', '#80B1D3',
+                    '#FDB462', '#B3DE69', '#FCCDE5', '#D9D9D9', '#BC80BD',
+                    '#CCEBC5', '#FFED6F')
+
+# Columns of task_on_date filled by reconstruct_task_on_date
+TASK_ON_DATE_COLUMNS = ('scope', 'date', 'id', 'status', 'project_id', 'project',
+                        'projectcolumn', 'points', 'maint_type', 'priority')
+
+# Time zones and format for the dates shown on reports
+UTC_TZ = pytz.utc
+PACIFIC_TZ = pytz.timezone('America/Los_Angeles')
+REPORT_DATE_FORMAT = '%a %Y-%b-%d %I:%M %p'
+
+# Strips double quotes from status transaction values
+QUOTE_TRANS_TABLE = str.maketrans('', '', '"')
+
+# Report pages are written to ../html/<scope_prefix>_<page>.html,
+# relative to the script directory
+HTML_OUTPUT_PATH = '../html/{0}_{1}.html'
+
+# Queries issued from more than one place, or once per reconstructed day
+GET_PROJECTS_BY_NAME_SQL = 'SELECT * FROM get_projects_by_name(%s)'
+GET_TASK_VALUES_ON_DATE_SQL = 'SELECT * FROM get_task_values_on_date(%s, %s)'
+
+# Rules allowed in a recategorization file
+VALID_RULES = frozenset(['ProjectByID', 'ProjectByName', 'ProjectsByWildcard',
+                         'Intersection', 'ProjectColumn', 'ParentTask'])
+
+
+class PhlogistonError(Exception):
+    """ Raised when the input data or configuration can't be processed"""
+    pass
+
 
 def main(argv):
     try:
@@ -134,21 +195,25 @@ def main(argv):
                 print('start_date must be in the config file or command line options')
                 sys.exit(1)
 
-    if reconstruct_data:
-        if scope_prefix:
-            reconstruct(conn, VERBOSE, DEBUG, default_points,
-                        start_date, end_date,
-                        scope_prefix, incremental)
-        else:
-            print("Reconstruct specified without a scope_prefix.\n Please specify a scope_prefix with --scope_prefix.")  # noqa
-    if run_report:
-        if scope_prefix:
-            report(conn, dbname, VERBOSE, DEBUG, scope_prefix,
-                   scope_title, default_points,
-                   retroactive_categories, retroactive_points,
-                   backlog_resolved_cutoff, show_points, show_count, start_date)
-        else:
-            print("Report specified without a scope_prefix.\nPlease specify a scope_prefix with --scope_prefix.")  # noqa
+    try:
+        if reconstruct_data:
+            if scope_prefix:
+                reconstruct(conn, VERBOSE, DEBUG, default_points,
+                            start_date, end_date,
+                            scope_prefix, incremental)
+            else:
+                print("Reconstruct specified without a scope_prefix.\n Please specify a scope_prefix with --scope_prefix.")  # noqa
+        if run_report:
+            if scope_prefix:
+                report(conn, VERBOSE, DEBUG, scope_prefix,
+                       scope_title, default_points,
+                       retroactive_categories, retroactive_points,
+                       backlog_resolved_cutoff, show_points, show_count, start_date)
+            else:
+                print("Report specified without a scope_prefix.\nPlease specify a scope_prefix with --scope_prefix.")  # noqa
+    except PhlogistonError as e:
+        print('ERROR: {0}'.format(e))
+        sys.exit(1)
     conn.close()
 
     if not (initialize or load_data or reconstruct_data or run_report):
@@ -185,153 +250,213 @@ Optionally:
   --verbose      Show progress messages.\n""")
 
 
+@functools.lru_cache(maxsize=None)
+def read_sql(path):
+    """Return the text of a SQL script, reading each file only once"""
+
+    with open(path, 'r') as sql_file:
+        return sql_file.read()
+
+
+@functools.lru_cache(maxsize=None)
+def get_template(path):
+    """Return a compiled Jinja template, parsing each file only once"""
+
+    with open(path, 'r') as template_file:
+        return Template(template_file.read())
+
+
 def do_initialize(conn, VERBOSE, DEBUG):
     cur = conn.cursor()
-    cur.execute(open("loading_tables.sql", "r").read())
-    cur.execute(open("loading_functions.sql", "r").read())
-    cur.execute(open("reconstruction_tables.sql", "r").read())
-    cur.execute(open("reconstruction_functions.sql", "r").read())
-    cur.execute(open("reporting_tables.sql", "r").read())
-    cur.execute(open("reporting_functions.sql", "r").read())
+    cur.execute(read_sql('loading_tables.sql'))
+    cur.execute(read_sql('loading_indexes.sql'))
+    cur.execute(read_sql('loading_functions.sql'))
+    cur.execute(read_sql('reconstruction_tables.sql'))
+    cur.execute(read_sql('reconstruction_functions.sql'))
+    cur.execute(read_sql('reporting_tables.sql'))
+    cur.execute(read_sql('reporting_functions.sql'))
 
 
 def load(conn, end_date, VERBOSE, DEBUG):
+    # Load everything in a single transaction so that the server flushes
+    # WAL once at the end rather than for every statement
+    conn.autocommit = False
+    try:
+        with conn:
+            load_dump(conn, VERBOSE)
+    finally:
+        conn.autocommit = True
+
+
+def load_dump(conn, VERBOSE):
     cur = conn.cursor()
-    cur.execute(open("loading_tables.sql", "r").read())
+    cur.execute(read_sql('loading_tables.sql'))
 
+    dump_path = '../phabricator_public.dump'
     if VERBOSE:
         print('{0} Loading dump file'.format(datetime.datetime.now()))
-    with open('../phabricator_public.dump') as dump_file:
-        data = json.load(dump_file)
 
     ######################################################################
     # Load project and project column data
     ######################################################################
-    if VERBOSE:
-        count = len(data['project']['projects'])
-        print("{0} Load {1} projects".format(datetime.datetime.now(), count))
+    # The dump is streamed in several passes rather than parsed into
+    # memory all at once.
 
-    project_insert = ("""INSERT INTO phabricator_project
-                VALUES (%(id)s, %(name)s, %(phid)s)""")
-    for row in data['project']['projects']:
-        cur.execute(project_insert,
-                    {'id': row[0], 'name': row[1], 'phid': row[2]})
+    project_columns = ('id', 'name', 'phid')
+    with open(dump_path, 'rb') as dump_file:
+        project_rows = [(row[0], row[1], row[2])
+                        for row in ijson.items(dump_file, 'project.projects.item')]
+    if VERBOSE:
+        print("{0} Load {1} projects".format(datetime.datetime.now(),
+                                             len(project_rows)))
+    copy_rows(cur, 'phabricator_project', project_columns, project_rows)
 
     cur.execute("SELECT phid, id from phabricator_project")
-    project_phid_to_id_dict = dict(cur.fetchall())
-
-    column_insert = ("""INSERT INTO phabricator_column
-                VALUES (%(id)s, %(phid)s, %(name)s, %(project_phid)s)""")
+    project_phid_to_id_dict = {phid: id for phid, id in cur}
+
+    column_columns = ('id', 'phid', 'name', 'project_phid')
+    column_rows = []
+    with open(dump_path, 'rb') as dump_file:
+        for row in ijson.items(dump_file, 'project.columns.item'):
+            phid = row[1]
+            project_phid = row[5]
+            if project_phid in project_phid_to_id_dict:
+                column_rows.append((row[0], phid, row[2], project_phid))
+            else:
+                print("Data error for column {0}: project {1} doesn't exist.Skipping.".
+                      format(phid, project_phid))
     if VERBOSE:
-        count = len(data['project']['columns'])
-        print("{0} Load {1} projectcolumns".format(datetime.datetime.now(), count))
-    for row in data['project']['columns']:
-        phid = row[1]
-        project_phid = row[5]
-        if project_phid in project_phid_to_id_dict:
-            cur.execute(column_insert,
-                        {'id': row[0], 'phid': phid,
-                         'name': row[2], 'project_phid': project_phid})
-        else:
-            print("Data error for column {0}: project {1} doesn't exist.Skipping.".
-                  format(phid, project_phid))
+        print("{0} Load {1} projectcolumns".format(datetime.datetime.now(),
+                                                   len(column_rows)))
+    copy_rows(cur, 'phabricator_column', column_columns, column_rows)
 
     ######################################################################
     # Load transactions and edges
     ######################################################################
 
-    transaction_insert = """
-      INSERT INTO maniphest_transaction
-      VALUES (%(id)s, %(phid)s, %(task_id)s, %(object_phid)s,
-              %(transaction_type)s, %(new_value)s, %(date_modified)s,
-              %(has_edge_data)s, %(active_projects)s)"""
+    transaction_columns = ('id', 'phid', 'task_id', 'object_phid',
+                           'transaction_type', 'new_value', 'date_modified',
+                           'has_edge_data', 'active_projects')
+    transaction_rows = []
 
-    task_insert = """
-      INSERT INTO maniphest_task
-      VALUES (%(task_id)s, %(phid)s, %(title)s, %(story_points)s, %(status_at_load)s) """
+    task_columns = ('id', 'phid', 'title', 'story_points', 'status_at_load')
+    task_rows = []
 
-    blocked_insert = """
-      INSERT INTO maniphest_blocked_phid
-      VALUES (%(date)s, %(phid)s, %(blocked_phid)s) """
+    # Blocking edges are few, so they are collected for the whole dump
+    # and sent in a single COPY at the end
+    blocked_columns = ('blocked_date', 'blocks_phid', 'blocked_by_phid')
+    blocked_rows = []
 
     if VERBOSE:
-        print("{0} Load tasks, transactions, and edges for {1} tasks".
-              format(datetime.datetime.now(), len(data['task'].keys())))
-
-    for task_id in data['task'].keys():
-        task = data['task'][task_id]
-        if task['info']:
-            task_phid = task['info'][1]
-            status_at_load = task['info'][4]
-            title = task['info'][6]
-            story_points = task['info'][10]
-        else:
-            task_phid = ''
-            status_at_load = ''
-            title = ''
-            story_points = ''
-        cur.execute(task_insert, {'task_id': task_id,
-                                  'phid': task_phid,
-                                  'title': title,
-                                  'story_points': story_points,
-                                  'status_at_load': status_at_load})
-
-        # Load blocked info for this task. When transactional data
-        # becomes available, this should use that instead
-        for edge in task['edge']:
-            if edge[1] == 3:
-                blocked_phid = edge[2]
-                cur.execute(blocked_insert,
-                            {'date': datetime.datetime.now().date(),
-                             'phid': task_phid,
-                             'blocked_phid': blocked_phid})
-
-        # Load transactions for this task
-        transactions = task['transactions']
-        quote_trans_table = {ord('"'): None}
-        for trans_key in list(transactions.keys()):
-            if transactions[trans_key]:
-                for trans in transactions[trans_key]:
-                    trans_type = trans[6]
-                    raw_new_value = trans[8]
-                    if trans_type == 'status':
-                        new_value = raw_new_value.translate(quote_trans_table)
-                    else:
-                        new_value = raw_new_value
-                    date_mod = time.strftime('%m/%d/%Y %H:%M:%S',
-                                             time.gmtime(trans[11]))
-                    # If this is an edge transaction, parse out the
-                    # list of transactions
-                    has_edge_data = False
-                    active_proj = list()
-                    if trans_type == 'core:edge':
-                        jblob = json.loads(new_value)
-                        if jblob:
-                            for key in jblob.keys():
-                                if int(jblob[key]['type']) == 41:
-                                    has_edge_data = True
-                                    if key in project_phid_to_id_dict:
-                                        proj_id = project_phid_to_id_dict[key]
-                                        active_proj.append(proj_id)
-                                    else:
-                                        print("Data error for transaction {0}: project {1} doesn't exist. Skipping.".format(trans[1], key))  # noqa
-                    cur.execute(transaction_insert,
-                                {'id': trans[0],
-                                 'phid': trans[1],
-                                 'task_id': task_id,
-                                 'object_phid': trans[3],
-                                 'transaction_type': trans_type,
-                                 'new_value': new_value,
-                                 'date_modified': date_mod,
-                                 'has_edge_data': has_edge_data,
-                                 'active_projects': active_proj})
-
+        print("{0} Load tasks, transactions, and edges".
+              format(datetime.datetime.now()))
+
+    # Local bindings for the inner transaction loop
+    get_proj = project_phid_to_id_dict.get
+    json_loads = json.loads
+    from_epoch = datetime.datetime.fromtimestamp
+    utc = datetime.timezone.utc
+    now_date = datetime.datetime.now().date()
+
+    with open(dump_path, 'rb') as dump_file:
+        for task_id, task in ijson.kvitems(dump_file, 'task'):
+            if task['info']:
+                task_phid = task['info'][1]
+                status_at_load = task['info'][4]
+                title = task['info'][6]
+                story_points = task['info'][10]
+            else:
+                task_phid = ''
+                status_at_load = ''
+                title = ''
+                story_points = ''
+            task_rows.append((task_id, task_phid, title, story_points, status_at_load))
+
+            # Load blocked info for this task. When transactional data
+            # becomes available, this should use that instead
+            for edge in task['edge']:
+                if edge[1] == 3:
+                    blocked_phid = edge[2]
+                    blocked_rows.append((now_date, task_phid, blocked_phid))
+
+            # Load transactions for this task
+            for trans_list in task['transactions'].values():
+                if trans_list:
+                    for trans in trans_list:
+                        trans_type = trans[6]
+                        raw_new_value = trans[8]
+                        if trans_type == 'status':
+                            new_value = raw_new_value.translate(QUOTE_TRANS_TABLE)
+                        else:
+                            new_value = raw_new_value
+                        date_mod = from_epoch(trans[11], utc)
+                        # If this is an edge transaction, parse out the
+                        # list of transactions
+                        has_edge_data = False
+                        active_proj = list()
+                        if trans_type == 'core:edge':
+                            jblob = json_loads(new_value)
+                            if jblob:
+                                for key in jblob.keys():
+                                    if int(jblob[key]['type']) == 41:
+                                        has_edge_data = True
+                                        proj_id = get_proj(key)
+                                        if proj_id is not None:
+                                            active_proj.append(proj_id)
+                                        else:
+                                            print("Data error for transaction {0}: project {1} doesn't exist. Skipping.".format(trans[1], key))  # noqa
+                        transaction_rows.append(
+                            (trans[0], trans[1], task_id, trans[3], trans_type,
+                             new_value, date_mod, has_edge_data, active_proj))
+
+            if len(transaction_rows) >= COPY_BATCH_SIZE:
+                copy_rows(cur, 'maniphest_transaction', transaction_columns,
+                          transaction_rows)
+                transaction_rows = []
+            if len(task_rows) >= COPY_BATCH_SIZE:
+                copy_rows(cur, 'maniphest_task', task_columns, task_rows)
+                task_rows = []
+
+    copy_rows(cur, 'maniphest_transaction', transaction_columns, transaction_rows)
+    copy_rows(cur, 'maniphest_task', task_columns, task_rows)
+    copy_rows(cur, 'maniphest_blocked_phid', blocked_columns, blocked_rows)
+
+    # Indexes are built once the tables are full, rather than
+    # maintained row by row during the load
+    cur.execute(read_sql('loading_indexes.sql'))
     cur.execute('SELECT convert_blocked_phid_to_id_sql()')
     cur.close()
     if VERBOSE:
         print('{0} Done loading dump file'.format(datetime.datetime.now()))
 
 
+def copy_format(value):
+    """Render one value in PostgreSQL COPY text format"""
+
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, list):
+        return '{' + ','.join(str(item) for item in value) + '}'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t').
+            replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_rows(cur, table, columns, rows):
+    """Send a list of row tuples to the database in a single COPY"""
+
+    if not rows:
+        return
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(copy_format(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_expert('COPY {0} ({1}) FROM STDIN'.format(table, ', '.join(columns)),
+                    buf)
+
+
 def reconstruct(conn, VERBOSE, DEBUG, default_points,
                 start_date, end_date, scope_prefix, incremental):
 
@@ -346,30 +471,34 @@ def reconstruct(conn, VERBOSE, DEBUG, default_points,
     # preload project and column for fast lookup
     ######################################################################
 
-    cur.execute("""SELECT name, phid
-                   FROM phabricator_project
-                  WHERE id IN %(project_id_list)s""",
-                {'project_id_list': tuple(project_id_list)})
-    lookups['project_name_to_phid_dict'] = dict(cur.fetchall())
-    cur.execute("""SELECT name, id
+    # Projects and their columns come back in one query, distinguished
+    # by the first column
+    cur.execute("""SELECT 'p', name, phid, id
                      FROM phabricator_project
-                    WHERE id IN %(project_id_list)s""",
-                {'project_id_list': tuple(project_id_list)})
-    project_name_to_id_dict = dict(cur.fetchall())
-    lookups['project_id_to_name_dict'] = {
-        value: key for key, value in project_name_to_id_dict.items()}
-
-    cur.execute("""SELECT pc.phid, pc.name
+                    WHERE id = ANY(%(project_id_list)s)
+                    UNION ALL
+                   SELECT 'c', pc.name, pc.phid, NULL
                      FROM phabricator_column pc,
                           phabricator_project pp
                     WHERE pc.project_phid = pp.phid
                       AND pp.id = ANY(%(project_id_list)s)""",
                 {'project_id_list': project_id_list})
-    lookups['column_dict'] = dict(cur.fetchall())
+    project_name_to_phid_dict = {}
+    project_name_to_id_dict = {}
+    column_dict = {}
+    for row in cur:
+        if row[0] == 'p':
+            project_name_to_phid_dict[row[1]] = row[2]
+            project_name_to_id_dict[row[1]] = row[3]
+        else:
+            column_dict[row[2]] = row[1]
+    lookups['project_name_to_phid_dict'] = project_name_to_phid_dict
+    lookups['project_id_to_name_dict'] = {
+        value: key for key, value in project_name_to_id_dict.items()}
+    lookups['column_dict'] = column_dict
+
     # In addition to scope_prefix-specific projects, include special, global tags
-    id_list_with_worktypes = list(project_id_list)
-    for i in PHAB_TAGS.keys():
-        id_list_with_worktypes.extend([PHAB_TAGS[i]])
+    id_list_with_worktypes = list(project_id_list) + list(PHAB_TAGS.values())
 
     ######################################################################
     # Generate denormalized data
@@ -397,53 +526,69 @@ def reconstruct(conn, VERBOSE, DEBUG, default_points,
             cur.execute(oldest_data_query)
             start_date = cur.fetchone()[0].date()
 
-    working_date = start_date
-
-    while working_date <= end_date:
-        if VERBOSE:
-            print('{0} {1}: Making maniphest_edge for {2}'.
-                  format(scope_prefix, datetime.datetime.now(), working_date))
-
-        cur.execute('SELECT build_edges(%(date)s, %(project_id_list)s)',
-                    {'date': working_date,
-                     'project_id_list': id_list_with_worktypes})
+    if VERBOSE:
+        print('{0} {1}: Making maniphest_edge for {2} to {3}'.
+              format(scope_prefix, datetime.datetime.now(), start_date, end_date))
 
-        working_date += datetime.timedelta(days=1)
+    cur.execute('SELECT build_edges_range(%(start_date)s, %(end_date)s, %(project_id_list)s)',  # noqa
+                {'start_date': start_date,
+                 'end_date': end_date,
+                 'project_id_list': id_list_with_worktypes})
 
     ######################################################################
     # Reconstruct historical state of tasks
     ######################################################################
 
-    working_date = start_date
-    while working_date <= end_date:
-        if VERBOSE:
-            print('{0} {1}: Reconstructing data for {2}'.
-                  format(scope_prefix, datetime.datetime.now(), working_date))
-
-        # because working_date is midnight at the beginning of the
-        # day, increment the count before using it so that the
-        # effective date used is midnight at the end of the day
-        working_date += datetime.timedelta(days=1)
-
-        cur.execute('SELECT get_tasks(%(working_date)s, %(project_ids)s)',
-                    {'working_date': working_date,
-                     'project_ids': project_id_list})
-        for row in cur.fetchall():
-            task_id = row[0]
-            reconstruct_task_on_date(cur, task_id, working_date, scope_prefix, DEBUG, default_points, **lookups)  # noqa
-
-        # Use as-is data to reconstruct certain relationships for working data
-        # see https://phabricator.wikimedia.org/T115936#1847188
-        cur.execute('SELECT * from get_phab_parent_categories_by_day(%(scope_prefix)s, %(working_date)s, %(category_tag_id)s)',  # noqa
-                    {'scope_prefix': scope_prefix,
-                     'working_date': working_date,
-                     'category_tag_id': PHAB_TAGS['category']})
-        for row in cur.fetchall():
-            category_id = row[0]
-            cur.execute('SELECT create_phab_parent_category_edges(%(scope_prefix)s, %(working_date)s, %(category_id)s)',  # noqa
-                        {'scope_prefix': scope_prefix,
-                         'category_id': category_id,
-                         'working_date': working_date})
+    # because each date is midnight at the beginning of the day, shift
+    # the range by one day so that the effective date used is midnight
+    # at the end of the day
+    first_date = start_date + datetime.timedelta(days=1)
+    last_date = end_date + datetime.timedelta(days=1)
+
+    if VERBOSE:
+        print('{0} {1}: Reconstructing data for {2} to {3}'.
+              format(scope_prefix, datetime.datetime.now(), first_date, last_date))
+
+    # Stream the task list through a server-side cursor so that only
+    # itersize rows are held in memory at a time.  WITH HOLD is needed
+    # because the connection is in autocommit mode.
+    task_cur = conn.cursor(name='get_tasks_cur', withhold=True)
+    task_cur.itersize = 2000
+    task_cur.execute('SELECT * FROM get_tasks_range(%(first_date)s, %(last_date)s, %(project_ids)s)',  # noqa
+                     {'first_date': first_date,
+                      'last_date': last_date,
+                      'project_ids': project_id_list})
+
+    # Days are independent of each other, so they are reconstructed
+    # concurrently, each worker on its own connection from the pool.
+    # Only a few days are queued ahead of the workers, to keep the
+    # streamed task list from piling up in memory.
+    max_workers = min(os.cpu_count() or 1, MAX_RECONSTRUCT_CONNECTIONS)
+    pool = psycopg2.pool.ThreadedConnectionPool(1, max_workers, conn.dsn)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = collections.deque()
+            days = itertools.groupby(task_cur, key=lambda row: row[0])
+            for working_date, date_rows in days:
+                task_ids = [row[1] for row in date_rows]
+                pending.append(executor.submit(
+                    reconstruct_day, pool, working_date, task_ids,
+                    scope_prefix, DEBUG, default_points, lookups))
+                if len(pending) >= 2 * max_workers:
+                    pending.popleft().result()
+            for future in pending:
+                future.result()
+    finally:
+        pool.closeall()
+        task_cur.close()
+
+    # Use as-is data to reconstruct certain relationships for working data
+    # see https://phabricator.wikimedia.org/T115936#1847188
+    cur.execute('SELECT create_phab_parent_category_edges(%(scope_prefix)s, %(first_date)s, %(last_date)s, %(category_tag_id)s)',  # noqa
+                {'scope_prefix': scope_prefix,
+                 'first_date': first_date,
+                 'last_date': last_date,
+                 'category_tag_id': PHAB_TAGS['category']})
 
     if VERBOSE:
         print('{0} {1} Updating Phab Parent Category Titles'.
@@ -463,7 +608,7 @@ def reconstruct(conn, VERBOSE, DEBUG, default_points,
               format(scope_prefix, datetime.datetime.now()))
 
 
-def report(conn, dbname, VERBOSE, DEBUG, scope_prefix,
+def report(conn, VERBOSE, DEBUG, scope_prefix,
            scope_title, default_points,
            retroactive_categories, retroactive_points,
            backlog_resolved_cutoff, show_points, show_count, start_date):
@@ -548,30 +693,28 @@ def report(conn, dbname, VERBOSE, DEBUG, scope_prefix,
     ######################################################################
     # Prepare all the csv files and working directories
     ######################################################################
-    # working around dynamic filename constructions limitations in
-    # psql rather than try to write the file /tmp/foo/report.csv,
-    # write the file /tmp/phlog/report.csv and then move it to
-    # /tmp/foo/report.csv
-    # note that all the COPY commands in the psql scripts run
-    # server-side as user postgres
-
-    subprocess.call('rm -rf /tmp/{0}/'.format(scope_prefix), shell=True)
-    subprocess.call('rm -rf /tmp/phlog/', shell=True)
-    subprocess.call('mkdir -p /tmp/{0}'.format(scope_prefix), shell=True)
-    subprocess.call('chmod g+w /tmp/{0}'.format(scope_prefix), shell=True)
-    subprocess.call('mkdir -p /tmp/phlog', shell=True)
-    subprocess.call('chmod g+w /tmp/phlog', shell=True)
-    subprocess.call('psql -d {0} -f make_report_csvs.sql -v scope_prefix={1}'.
-                    format(dbname, scope_prefix), shell=True)
-    subprocess.call('mv /tmp/phlog/* /tmp/{0}/'.
-                    format(scope_prefix), shell=True)
-    subprocess.call('rm ~/html/{0}_*'.format(scope_prefix), shell=True)
+    # The COPY commands in make_report_csvs.sql are run on this
+    # connection and streamed to files in /tmp/[scope_prefix]
+
+    scope_tmp_dir = '/tmp/{0}'.format(scope_prefix)
+    html_dir = os.path.expanduser('~/html')
+
+    shutil.rmtree(scope_tmp_dir, ignore_errors=True)
+    os.makedirs(scope_tmp_dir, exist_ok=True)
+    run_report_csvs(cur, scope_prefix, scope_tmp_dir)
+    for html_path in glob.glob(os.path.join(html_dir, '{0}_*'.format(scope_prefix))):
+        os.remove(html_path)
 
     script_dir = os.path.dirname(__file__)
 
-    subprocess.call('cp /tmp/{0}/maintenance_fraction_total_by_points.csv ~/html/{0}_maintenance_fraction_total_by_points.csv'.format(scope_prefix), shell=True)  # noqa
-    subprocess.call('cp /tmp/{0}/maintenance_fraction_total_by_count.csv ~/html/{0}_maintenance_fraction_total_by_count.csv'.format(scope_prefix), shell=True)  # noqa
-    subprocess.call('cp /tmp/{0}/category_possibilities.txt ~/html/{0}_category_possibilities.txt'.format(scope_prefix), shell=True)  # noqa
+    for filename in ['maintenance_fraction_total_by_points.csv',
+                     'maintenance_fraction_total_by_count.csv',
+                     'category_possibilities.txt']:
+        try:
+            shutil.copy(os.path.join(scope_tmp_dir, filename),
+                        os.path.join(html_dir, '{0}_{1}'.format(scope_prefix, filename)))
+        except FileNotFoundError as e:
+            print(e)
 
     ######################################################################
     # for each category, generate burnup charts
@@ -580,39 +723,27 @@ def report(conn, dbname, VERBOSE, DEBUG, scope_prefix,
     cur.execute('SELECT * FROM get_categories(%(scope_prefix)s)',
                 {'scope_prefix': scope_prefix})
     cat_list = cur.fetchall()
-    colors = []
-    proc = subprocess.check_output("Rscript get_palette.R {0}".
-                                   format(len(cat_list)), shell=True)
-    color_output = proc.decode().split()
-    for item in color_output:
-        if '#' in item:
-            colors.append(item)
-
+    tranche_commands = []
     i = 0
     for cat_entry in reversed(cat_list):
         category = cat_entry[0]
         try:
-            color = colors[i]
-        except:
-            color = '"#DDDDDD"'
-
-        tranche_args = {'scope_prefix': scope_prefix,
-                        'i': i,
-                        'color': color,
-                        'category': category,
-                        'report_date': report_date,
-                        'chart_start': chart_start,
-                        'chart_end': chart_end,
-                        'current_quarter_start': current_quarter_start,
-                        'next_quarter_start': next_quarter_start}
-
-        tranche_command = "Rscript make_tranche_chart.R {scope_prefix} {i} {color} \"{category}\" {report_date} {chart_start} {chart_end} {current_quarter_start} {next_quarter_start}"  # noqa
+            color = CATEGORY_PALETTE[i]
+        except IndexError:
+            color = '#DDDDDD'
+
+        tranche_command = ['Rscript', 'make_tranche_chart.R', scope_prefix,
+                           str(i), color, category, str(report_date),
+                           str(chart_start), str(chart_end),
+                           str(current_quarter_start), str(next_quarter_start)]
         if DEBUG:
-            print(tranche_command.format(**tranche_args))
-        subprocess.call(tranche_command.format(**tranche_args), shell=True)
+            print(' '.join(tranche_command))
+        tranche_commands.append(tranche_command)
 
         i += 1
 
+    run_commands_in_parallel(tranche_commands)
+
     if VERBOSE:
         print('{0} {1}: Finished making tranch charts, starting on reports'.
               format(scope_prefix, datetime.datetime.now()))
@@ -620,49 +751,45 @@ def report(conn, dbname, VERBOSE, DEBUG, scope_prefix,
     cur.execute('SELECT * FROM get_forecast_weeks(%(scope_prefix)s)',
                 {'scope_prefix': scope_prefix})
     forecast_rows = cur.fetchall()
-    forecast_html = Template(open('html/forecast.html').read())
-    file_path = '../html/{0}_current_forecasts.html'.format(scope_prefix)
-    forecast_output = open(os.path.join(script_dir, file_path), 'w')
-    forecast_output.write(forecast_html.render(
-        {'forecast_rows': forecast_rows,
-         'show_points': show_points,
-         'show_count': show_count}))
-    forecast_output.close()
+    forecast_html = get_template('html/forecast.html')
+    file_path = HTML_OUTPUT_PATH.format(scope_prefix, 'current_forecasts')
+    with open(os.path.join(script_dir, file_path), 'w') as forecast_output:
+        forecast_html.stream(
+            {'forecast_rows': forecast_rows,
+             'show_points': show_points,
+             'show_count': show_count}).dump(forecast_output)
 
     cur.execute('SELECT * FROM get_open_task_list(%(scope_prefix)s)',
                 {'scope_prefix': scope_prefix})
     open_tasks_rows = cur.fetchall()
-    open_tasks_html = Template(open('html/open_tasks.html').read())
-    file_path = '../html/{0}_open_by_category.html'.format(scope_prefix)
-    open_tasks_output = open(os.path.join(script_dir, file_path), 'w')
-    open_tasks_output.write(open_tasks_html.render(
-        {'open_tasks_rows': open_tasks_rows,
-         'title': scope_title}))
-    open_tasks_output.close()
+    open_tasks_html = get_template('html/open_tasks.html')
+    file_path = HTML_OUTPUT_PATH.format(scope_prefix, 'open_by_category')
+    with open(os.path.join(script_dir, file_path), 'w') as open_tasks_output:
+        open_tasks_html.stream(
+            {'open_tasks_rows': open_tasks_rows,
+             'title': scope_title}).dump(open_tasks_output)
 
     cur.execute('SELECT * FROM get_unpointed_tasks(%(scope_prefix)s)',
                 {'scope_prefix': scope_prefix})
     unpointed_tasks_rows = cur.fetchall()
-    unpointed_html = Template(open('html/unpointed.html').read())
-    file_path = '../html/{0}_unpointed.html'.format(scope_prefix)
-    unpointed_output = open(os.path.join(script_dir, file_path), 'w')
-    unpointed_output.write(unpointed_html.render(
-        {'unpointed_tasks_rows': unpointed_tasks_rows,
-         'title': scope_title,
-         }))
-    unpointed_output.close()
+    unpointed_html = get_template('html/unpointed.html')
+    file_path = HTML_OUTPUT_PATH.format(scope_prefix, 'unpointed')
+    with open(os.path.join(script_dir, file_path), 'w') as unpointed_output:
+        unpointed_html.stream(
+            {'unpointed_tasks_rows': unpointed_tasks_rows,
+             'title': scope_title,
+             }).dump(unpointed_output)
 
     cur.execute('SELECT * FROM get_recently_closed_tasks(%(scope_prefix)s)',
                 {'scope_prefix': scope_prefix})
     recently_closed_tasks_rows = cur.fetchall()
-    recently_closed_html = Template(open('html/recently_closed.html').read())
-    file_path = '../html/{0}_recently_closed.html'.format(scope_prefix)
-    recently_closed_output = open(os.path.join(script_dir, file_path), 'w')
-    recently_closed_output.write(recently_closed_html.render(
-        {'recently_closed_tasks_rows': recently_closed_tasks_rows,
-         'title': scope_title,
-         }))
-    recently_closed_output.close()
+    recently_closed_html = get_template('html/recently_closed.html')
+    file_path = HTML_OUTPUT_PATH.format(scope_prefix, 'recently_closed')
+    with open(os.path.join(script_dir, file_path), 'w') as recently_closed_output:
+        recently_closed_html.stream(
+            {'recently_closed_tasks_rows': recently_closed_tasks_rows,
+             'title': scope_title,
+             }).dump(recently_closed_output)
 
     ######################################################################
     # Make the summary charts
@@ -672,19 +799,21 @@ def report(conn, dbname, VERBOSE, DEBUG, scope_prefix,
         print('{0} {1}: Finished making reports, starting on summary charts'.
               format(scope_prefix, datetime.datetime.now()))
 
-    if DEBUG:
-        print("""Rscript make_charts.R {0} {1} {2} {3} {4} {5}\
-        {6} {7} {8} {9}""".format(scope_prefix, scope_title, False,
-                                  report_date, current_quarter_start, next_quarter_start,
-                                  previous_quarter_start, chart_start, chart_end,
-                                  three_months_ago))
+    # scope_title keeps the shell quoting from the config file (single
+    # or double quotes); without a shell it must be undone here
+    chart_title = ' '.join(shlex.split(scope_title))
 
+    # The showhidden runs write some of the same files, so they run one
+    # after the other, with the unhidden charts written last
     for i in [True, False]:
-        subprocess.call("""Rscript make_charts.R {0} {1} {2} {3} {4} {5}\
-        {6} {7} {8} {9}""".format(scope_prefix, scope_title, i,
-                                  report_date, current_quarter_start, next_quarter_start,
-                                  previous_quarter_start, chart_start, chart_end,
-                                  three_months_ago), shell=True)
+        chart_command = ['Rscript', 'make_charts.R', scope_prefix,
+                         chart_title, str(i), str(report_date),
+                         str(current_quarter_start), str(next_quarter_start),
+                         str(previous_quarter_start), str(chart_start),
+                         str(chart_end), str(three_months_ago)]
+        if DEBUG:
+            print(' '.join(chart_command))
+        subprocess.call(chart_command)
 
     ######################################################################
     # Update dates
@@ -698,58 +827,52 @@ def report(conn, dbname, VERBOSE, DEBUG, scope_prefix,
 
     cur.execute(max_date_query, {'scope_prefix': scope_prefix})
     result = cur.fetchone()
-    max_date = result[0]
-    now_db = result[1]
-    utc = pytz.utc
-    pt = pytz.timezone('America/Los_Angeles')
-    max_date_utc = max_date.astimezone(utc).strftime('%a %Y-%b-%d %I:%M %p')
-    max_date_pt = max_date.astimezone(pt).strftime('%a %Y-%b-%d %I:%M %p')
-    now_utc = now_db.astimezone(utc).strftime('%a %Y-%b-%d %I:%M %p')
-    now_pt = now_db.astimezone(pt).strftime('%a %Y-%b-%d %I:%M %p')
-
-    date_row_html = Template(open('html/date_row.html').read())
-    date_row_output = open(os.path.join(script_dir, '../html/{0}_date_row.html'.format(scope_prefix)), 'w')  # noqa
-    date_row_output.write(date_row_html.render(
-        {'max_date_pt': max_date_pt,
-         'now_pt': now_pt
-         }))
-    date_row_output.close()
+    max_date_utc, max_date_pt = format_report_date(result[0])
+    now_utc, now_pt = format_report_date(result[1])
+
+    date_row_html = get_template('html/date_row.html')
+    file_path = HTML_OUTPUT_PATH.format(scope_prefix, 'date_row')
+    with open(os.path.join(script_dir, file_path), 'w') as date_row_output:
+        date_row_output.write(date_row_html.render(
+            {'max_date_pt': max_date_pt,
+             'now_pt': now_pt
+             }))
 
     cur.execute('SELECT * FROM get_category_rules(%(scope_prefix)s)',
                 {'scope_prefix': scope_prefix})
     category_rules_list = cur.fetchall()
 
     project_name_list = get_project_list_from_recategorization(conn, scope_prefix)[1]
-    rules_html = Template(open('html/rules.html').read())
-    rules_output = open(os.path.join(script_dir, '../html/{0}_rules.html'.format(scope_prefix)), 'w')  # noqa
-    rules_output.write(rules_html.render(
-        {'title': scope_title,
-         'start_date': start_date,
-         'project_name_list': project_name_list,
-         'category_rules_list': category_rules_list
-         }))
-    rules_output.close()
-
-    report_html = Template(open('html/report.html').read())
-    report_output = open(os.path.join(script_dir, '../html/{0}_report.html'.format(scope_prefix)), 'w')  # noqa
-    report_output.write(report_html.render(
-        {'title': scope_title,
-         'scope_prefix': scope_prefix,
-         'default_points': default_points,
-         'show_points': show_points,
-         'show_count': show_count,
-         'max_date_pt': max_date_pt,
-         'max_date_utc': max_date_utc,
-         'now_pt': now_pt,
-         'now_utc': now_utc,
-         'category_count': len(cat_list),
-         'category_list': cat_list,
-         'rev_category_list': reversed(cat_list),
-         'retroactive_categories': retroactive_categories,
-         'retroactive_points': retroactive_points,
-         'backlog_resolved_cutoff': backlog_resolved_cutoff,
-         }))
-    report_output.close()
+    rules_html = get_template('html/rules.html')
+    file_path = HTML_OUTPUT_PATH.format(scope_prefix, 'rules')
+    with open(os.path.join(script_dir, file_path), 'w') as rules_output:
+        rules_output.write(rules_html.render(
+            {'title': scope_title,
+             'start_date': start_date,
+             'project_name_list': project_name_list,
+             'category_rules_list': category_rules_list
+             }))
+
+    report_html = get_template('html/report.html')
+    file_path = HTML_OUTPUT_PATH.format(scope_prefix, 'report')
+    with open(os.path.join(script_dir, file_path), 'w') as report_output:
+        report_output.write(report_html.render(
+            {'title': scope_title,
+             'scope_prefix': scope_prefix,
+             'default_points': default_points,
+             'show_points': show_points,
+             'show_count': show_count,
+             'max_date_pt': max_date_pt,
+             'max_date_utc': max_date_utc,
+             'now_pt': now_pt,
+             'now_utc': now_utc,
+             'category_count': len(cat_list),
+             'category_list': cat_list,
+             'rev_category_list': reversed(cat_list),
+             'retroactive_categories': retroactive_categories,
+             'retroactive_points': retroactive_points,
+             'backlog_resolved_cutoff': backlog_resolved_cutoff,
+             }))
 
     cur.close()
     if VERBOSE:
@@ -757,6 +880,56 @@ def report(conn, dbname, VERBOSE, DEBUG, scope_prefix,
               format(scope_prefix, datetime.datetime.now()))
 
 
+def format_report_date(timestamp):
+    """Return timestamp formatted for the reports in UTC and in Pacific
+    time.  Naive timestamps are taken to be UTC."""
+
+    if timestamp.tzinfo is None:
+        utc_timestamp = timestamp.replace(tzinfo=UTC_TZ)
+    else:
+        utc_timestamp = timestamp.astimezone(UTC_TZ)
+    pt_timestamp = utc_timestamp.astimezone(PACIFIC_TZ)
+    return (utc_timestamp.strftime(REPORT_DATE_FORMAT),
+            pt_timestamp.strftime(REPORT_DATE_FORMAT))
+
+
+def run_report_csvs(cur, scope_prefix, output_dir):
+    """Run make_report_csvs.sql on an open cursor.  The script is
+    written for psql, so substitute the scope_prefix variable and turn
+    each server-side COPY ... TO 'file' into COPY ... TO STDOUT written
+    to a file of the same name in output_dir."""
+
+    scope_literal = cur.mogrify('%s', (scope_prefix,)).decode()
+    sql = read_sql('make_report_csvs.sql')
+    sql = re.sub(r'/\*.*?\*/', '', sql, flags=re.DOTALL)
+    sql = re.sub(r'--[^\n]*', '', sql)
+    for statement in sql.split(';'):
+        statement = statement.strip().replace(":'scope_prefix'", scope_literal)
+        if not statement:
+            continue
+        copy_match = COPY_TO_FILE_RE.match(statement)
+        if copy_match:
+            query, file_path, options = copy_match.groups()
+            output_path = os.path.join(output_dir, os.path.basename(file_path))
+            with open(output_path, 'w') as output_file:
+                cur.copy_expert('{0} TO STDOUT{1}'.format(query, options),
+                                output_file)
+        else:
+            cur.execute(statement)
+
+
+def run_commands_in_parallel(commands):
+    """Run independent commands concurrently and wait for all of them to
+    finish.  Each command is an argument list, run without a shell."""
+
+    max_workers = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(subprocess.call, command)
+                   for command in commands]
+        for future in futures:
+            future.result()
+
+
 def get_project_list_from_recategorization(conn, scope_prefix):
     """Given a list of recategorization rules in the database,
     return a list (by id) of all categories mentioned in the rules.
@@ -764,23 +937,27 @@ def get_project_list_from_recategorization(conn, scope_prefix):
     project name wildcards"""
 
     cur = conn.cursor()
-    project_id_list = []
-    category_id_query = """SELECT project_id_list
-                             FROM category
-                            WHERE scope = %(scope_prefix)s"""
+    # Each id is listed once, at its first appearance in rule order,
+    # because reconstruction gives priority to projects earlier in the
+    # list
+    category_id_query = """
+        WITH ids AS (
+             SELECT DISTINCT ON (u.id) u.id, c.sort_order, u.ord
+               FROM category c,
+                    unnest(c.project_id_list) WITH ORDINALITY AS u(id, ord)
+              WHERE c.scope = %(scope_prefix)s
+              ORDER BY u.id, c.sort_order, u.ord)
+        SELECT ids.id, pp.name
+          FROM ids LEFT OUTER JOIN phabricator_project pp ON pp.id = ids.id
+         ORDER BY ids.sort_order, ids.ord"""
 
     cur.execute(category_id_query, {'scope_prefix': scope_prefix})
-    for row in cur.fetchall():
-        result_list = row[0]
-        for id in result_list:
-            if id not in project_id_list:
-                project_id_list.append(id)
-
-    project_name_list = {}
-    cur.execute("SELECT name FROM phabricator_project WHERE id = ANY(%s)",
-                (project_id_list,))
-    result = cur.fetchall()
-    project_name_list = [x[0] for x in result]
+    project_id_list = []
+    project_name_list = []
+    for row in cur:
+        project_id_list.append(row[0])
+        if row[1] is not None:
+            project_name_list.append(row[1])
 
     return project_id_list, project_name_list
 
@@ -793,121 +970,84 @@ def import_recategorization_file(conn, scope_prefix):
     cur.execute('DELETE FROM category WHERE scope = %(scope_prefix)s',
                 {'scope_prefix': scope_prefix})
 
-    insert_sql = """INSERT INTO category VALUES (
-                    %(scope)s,
-                    %(sort_order)s,
-                    %(rule)s,
-                    %(project_id_list)s,
-                    %(project_name_list)s,
-                    %(matchstring)s,
-                    %(title)s,
-                    %(display)s)"""
-
     recat_file = '{0}_recategorization.csv'.format(scope_prefix)
     if not os.path.isfile(recat_file):
-        raise Exception('Missing recat file {0}'.recat_file)
+        raise PhlogistonError('Missing recat file {0}'.format(recat_file))
+
+    # Rows are collected and inserted together at the end.  Duplicates,
+    # which would violate the unique constraint on category, are
+    # skipped here instead.
+    category_rows = []
+    category_keys = set()
+    id_set = set()
+
+    def add_category(line, rule, project_id_list, project_name_list,
+                     matchstring, title, display):
+        key = (rule, tuple(project_id_list), matchstring)
+        if key in category_keys:
+            print('Skipping a duplicate category produced by rule {0}: {1}'.
+                  format(line, key))
+            return
+        category_keys.add(key)
+        category_rows.append([scope_prefix, len(category_rows), rule,
+                              project_id_list, project_name_list,
+                              matchstring, title, display])
+
     with open(recat_file, 'rt') as f:
         reader = csv.DictReader(f)
-        counter = 0
-        valid_rule_list = ['ProjectByID', 'ProjectByName', 'ProjectsByWildcard',
-                           'Intersection', 'ProjectColumn', 'ParentTask']
         for line in reader:
+            counter = len(category_rows)
 
-            try:
-                matchstring = line['matchstring']
-            except (KeyError,  TypeError):
-                matchstring = ''
+            # optional columns may be absent from the header, or None
+            # when a row is shorter than the header
+            matchstring = line.get('matchstring') or ''
 
             rule = line['rule']
-            if rule not in valid_rule_list:
-                raise Exception('Error in recat file {0} line {1}: {2} is not a valid rule.  Must be one of {3}'.format(recat_file, counter, rule, valid_rule_list))  # noqa
-                quit()
+            if rule not in VALID_RULES:
+                raise PhlogistonError('Error in recat file {0} line {1}: {2} is not a valid rule.  Must be one of {3}'.format(recat_file, counter, rule, ', '.join(sorted(VALID_RULES))))  # noqa
 
-            try:
-                title = line['title']
-            except KeyError:
-                title = ''
-
-            id_list = []
-            try:
-                if line['id']:
-                    id_list = [int(i) for i in line['id'].split()]
-            except KeyError:
-                pass
-
-            display = True
-            try:
-                if line['display'].lower() in ['false', 'f', 'no', '0']:
-                    display = False
-            except KeyError:
-                pass
+            title = line.get('title') or ''
+            id_list = [int(i) for i in (line.get('id') or '').split()]
+            display = ((line.get('display') or '').strip().lower() not in
+                       ('false', 'f', 'no', '0'))
 
             if rule != 'Intersection' and len(id_list) > 1:
-                raise Exception('Error in recat file {0} line {1}: {2} is not a valid rule.  This type of rule should have only one id specified'.format(recat_file, counter, line))  # noqa
+                raise PhlogistonError('Error in recat file {0} line {1}: {2} is not a valid rule.  This type of rule should have only one id specified'.format(recat_file, counter, line))  # noqa
             if rule == 'ProjectsByWildcard':
                 wildcard_match = '%{0}%'.format(matchstring)
-                cur.execute("SELECT * FROM get_projects_by_name(%s)", (wildcard_match,))
-                for row in cur.fetchall():
+                cur.execute(GET_PROJECTS_BY_NAME_SQL, (wildcard_match,))
+                for row in cur:
                     project_id = row[0]
                     name = row[1]
-
-                    try:
-                        cur.execute(insert_sql,
-                                    {'scope': scope_prefix,
-                                     'sort_order': counter,
-                                     'rule': 'ProjectByID',
-                                     'project_id_list': [project_id, ],
-                                     'project_name_list': [name, ],
-                                     'matchstring': '',
-                                     'title': name,
-                                     'display': display})
-                        counter += 1
-                    except psycopg2.IntegrityError as E:
-                        print('Skipping a duplicate category produced by rule {0}: {1}'.
-                              format(line, E))
+                    add_category(line, 'ProjectByID', [project_id, ], [name, ],
+                                 '', name, display)
             elif rule == 'ProjectByName':
-                cur.execute("SELECT * FROM get_projects_by_name(%s)", (matchstring,))
+                cur.execute(GET_PROJECTS_BY_NAME_SQL, (matchstring,))
                 row = cur.fetchone()
                 try:
                     project_id = row[0]
                 except TypeError:
-                    raise Exception('Error in recat file {0} line {1}: {2} is not a valid rule.  No matching project found for name {3}'.format(recat_file, counter, line, matchstring))  # noqa
-
-                try:
-                    cur.execute(insert_sql,
-                                {'scope': scope_prefix,
-                                 'sort_order': counter,
-                                 'rule': 'ProjectByID',
-                                 'project_id_list': [project_id, ],
-                                 'project_name_list': [matchstring, ],
-                                 'matchstring': '',
-                                 'title': title,
-                                 'display': display})
-                    counter += 1
-                except psycopg2.IntegrityError as E:
-                    print('Skipping a duplicate category produced by rule {0}: {1}'.
-                          format(line, E))
+                    raise PhlogistonError('Error in recat file {0} line {1}: {2} is not a valid rule.  No matching project found for name {3}'.format(recat_file, counter, line, matchstring))  # noqa
+                add_category(line, 'ProjectByID', [project_id, ], [matchstring, ],
+                             '', title, display)
             else:
-                name_list = {}
-                cur.execute("SELECT name FROM phabricator_project WHERE id = ANY(%s)",
-                            (id_list,))
-                result = cur.fetchall()
-                name_list = [x[0] for x in result]
+                # project names are filled in below, with one query for
+                # all rules
+                id_set.update(id_list)
+                add_category(line, rule, id_list, None, matchstring, title, display)
 
-                try:
-                    cur.execute(insert_sql,
-                                {'scope': scope_prefix,
-                                 'sort_order': counter,
-                                 'rule': rule,
-                                 'project_id_list': id_list,
-                                 'project_name_list': name_list,
-                                 'matchstring': matchstring,
-                                 'title': line['title'],
-                                 'display': display})
-                    counter += 1
-                except psycopg2.IntegrityError as E:
-                    print('Skipping a duplicate category produced by rule {0}: {1}'.
-                          format(line, E))
+    cur.execute("SELECT id, name FROM phabricator_project WHERE id = ANY(%s)",
+                (list(id_set),))
+    project_id_to_name_dict = dict(cur)
+    for row in category_rows:
+        if row[4] is None:
+            row[4] = [project_id_to_name_dict[project_id] for project_id in row[3]
+                      if project_id in project_id_to_name_dict]
+
+    if category_rows:
+        values = ','.join(cur.mogrify('(%s, %s, %s, %s, %s, %s, %s, %s)', row).decode()
+                          for row in category_rows)
+        cur.execute('INSERT INTO category VALUES ' + values)
 
 
 def recategorize(conn, scope_prefix, VERBOSE):
@@ -918,42 +1058,9 @@ def recategorize(conn, scope_prefix, VERBOSE):
               format(scope_prefix, datetime.datetime.now()))
     cur = conn.cursor()
 
-    cur.execute('SELECT * FROM get_category_rules(%(scope_prefix)s)', {'scope_prefix': scope_prefix})  # noqa
-
-    for row in cur.fetchall():
-        rule = row[0]
-        project_id_list = row[1]
-        matchstring = row[3]
-        title = row[4]
-        scope_prefix = scope_prefix
-
-        if rule == "ProjectByID":
-            cur.execute('SELECT recategorize_by_project(%(scope_prefix)s, %(project_id_list)s, %(title)s)',  # noqa
-                        {'scope_prefix': scope_prefix,
-                         'project_id_list': project_id_list,
-                         'title': title})
-        elif rule == "Intersection":
-            cur.execute('SELECT recategorize_by_intersection(%(scope_prefix)s, %(project_id_list)s, %(title)s)',  # noqa
-                        {'scope_prefix': scope_prefix,
-                         'project_id_list': project_id_list,
-                         'title': title})
-        elif rule == "ProjectColumn":
-            cur.execute('SELECT recategorize_by_column(%(scope_prefix)s, %(project_id_list)s, %(title)s, %(matchstring)s)',  # noqa
-                        {'scope_prefix': scope_prefix,
-                         'project_id_list': project_id_list,
-                         'title': title,
-                         'matchstring': matchstring})
-        elif rule == "ParentTask":
-            cur.execute('SELECT recategorize_by_parenttask(%(scope_prefix)s, %(project_id_list)s, %(title)s, %(matchstring)s)',  # noqa
-                        {'scope_prefix': scope_prefix,
-                         'project_id_list': project_id_list,
-                         'title': title,
-                         'matchstring': matchstring})
-        else:
-            raise Exception("Invalid categorization rule {0}".format(rule))
-            sys.exit()
-
-    cur.execute('SELECT purge_leftover_task_on_date(%(scope_prefix)s)',
+    # rules are applied in sort order and leftover uncategorized rows
+    # purged, all on the server in one round-trip
+    cur.execute('SELECT recategorize_all(%(scope_prefix)s)',
                 {'scope_prefix': scope_prefix})
     if VERBOSE:
         print('{0} {1}: Recategorization complete'.
@@ -961,13 +1068,60 @@ def recategorize(conn, scope_prefix, VERBOSE):
 
 
 def start_of_quarter(input_date):
-    quarter_start = [datetime.date(input_date.year, month, 1) for month in (1, 4, 7, 10)]
+    month = ((input_date.month - 1) // 3) * 3 + 1
+    return datetime.date(input_date.year, month, 1)
+
+
+def prefetch_day(cur, working_date, task_ids):
+    """Return everything reconstruct_task_on_date needs to know about
+    each task on one day, keyed by task id: story points from the task
+    record, the most recent status, priority and points transactions,
+    the active projects, and all column transactions, most recent
+    first."""
+
+    cur.execute(GET_TASK_VALUES_ON_DATE_SQL, (working_date, task_ids))
+    return {row[0]: row[1:] for row in cur}
 
-    index = bisect.bisect(quarter_start, input_date)
-    return quarter_start[index - 1]
 
+def reconstruct_day(pool, working_date, task_ids, scope_prefix, DEBUG,
+                    default_points, lookups):
+    """Reconstruct and store every task in the scope for one day, using
+    a connection borrowed from pool"""
 
-def reconstruct_task_on_date(cur, task_id, working_date, scope_prefix, DEBUG,
+    day_conn = pool.getconn()
+    try:
+        day_conn.autocommit = True
+        cur = day_conn.cursor()
+        day_values = prefetch_day(cur, working_date, task_ids)
+        task_on_date_rows = []
+        for task_id in task_ids:
+            task_on_date_row = reconstruct_task_on_date(task_id, working_date, day_values[task_id], scope_prefix, DEBUG, default_points, **lookups)  # noqa
+            if task_on_date_row:
+                task_on_date_rows.append(task_on_date_row)
+        copy_rows(cur, 'task_on_date', TASK_ON_DATE_COLUMNS, task_on_date_rows)
+        cur.close()
+    finally:
+        pool.putconn(day_conn)
+
+
+def to_int(value):
+    """ Return value as an int, or None if it can't be converted"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_pc(pc_trans):
+    """ Parse a core:columns transaction value.  Many tasks share the
+    same transaction on a given day, so parsed values are cached by the
+    raw string; callers must not modify the result."""
+    return json.loads(pc_trans)[0]
+
+
+def reconstruct_task_on_date(task_id, working_date, task_values,
+                             scope_prefix, DEBUG,
                              default_points, project_id_list,
                              project_id_to_name_dict,
                              project_name_to_phid_dict, column_dict):
@@ -979,18 +1133,8 @@ def reconstruct_task_on_date(cur, task_id, working_date, scope_prefix, DEBUG,
     # Title could be tracked through transactions but this code doesn't
     # make that effort.
     # ----------------------------------------------------------------------
-    task_info_query = """SELECT title, story_points
-    FROM maniphest_task
-    WHERE id = %(task_id)s"""
-    cur.execute(task_info_query,
-                {'task_id': task_id,
-                 'working_date': working_date,
-                 'transaction_type': 'status'})
-    task_info = cur.fetchone()
-    try:
-        points_from_info = int(task_info[1])
-    except:
-        points_from_info = None
+    (story_points, status_raw, priority_raw, points_raw, edges,
+     pc_trans_list) = task_values
 
     # for each relevant variable of the task, use the most
     # recent value that is no later than that day.  (So, if
@@ -1001,56 +1145,35 @@ def reconstruct_task_on_date(cur, task_id, working_date, scope_prefix, DEBUG,
     # ----------------------------------------------------------------------
     # Status
     # ----------------------------------------------------------------------
-    cur.execute("SELECT * FROM get_transaction_value(%s, %s, %s)",
-                (working_date, 'status', task_id))
-    status_raw = cur.fetchone()
     pretty_status = ""
-    if status_raw:
-        pretty_status = status_raw[0]
+    if status_raw is not None:
+        pretty_status = status_raw
 
     # ----------------------------------------------------------------------
     # Priority
     # ----------------------------------------------------------------------
-    cur.execute("SELECT * FROM get_transaction_value(%s, %s, %s)",
-                (working_date, 'priority', task_id))
-    priority_raw = cur.fetchone()
     pretty_priority = ""
-    if priority_raw:
-        pretty_priority = priority_raw[0]
+    if priority_raw is not None:
+        pretty_priority = priority_raw
 
     # ----------------------------------------------------------------------
     # Story Points
     # ----------------------------------------------------------------------
-    cur.execute("SELECT * FROM get_transaction_value(%s, %s, %s)",
-                (working_date, 'points', task_id))
-    points_raw = cur.fetchone()
-    try:
-        points_from_trans = int(points_raw[0])
-    except:
-        points_from_trans = None
-
-    if points_from_trans:
-        pretty_points = points_from_trans
-    elif points_from_info:
-        pretty_points = points_from_info
-    else:
-        pretty_points = default_points
+    pretty_points = (to_int(points_raw) or to_int(story_points) or
+                     default_points)
 
     # ----------------------------------------------------------------------
     # Project & Maintenance Type
     # ----------------------------------------------------------------------
-    cur.execute("SELECT * FROM get_edge_value(%s, %s)",
-                (working_date, task_id))
-    edges = cur.fetchall()[0][0]
     pretty_project = ''
 
     if not edges:
-        raise Exception('Task {0} has no edges; it may have been removed from\
+        raise PhlogistonError('Task {0} has no edges; it may have been removed from\
         the data, in which case a complete rebuild is appropriate'.format(task_id))
-        sys.exit()
-    if PHAB_TAGS['new'] in edges:
+    edge_set = set(edges)
+    if PHAB_TAGS['new'] in edge_set:
         maint_type = 'New Functionality'
-    elif PHAB_TAGS['maint'] in edges:
+    elif PHAB_TAGS['maint'] in edge_set:
         maint_type = 'Maintenance'
     else:
         maint_type = ''
@@ -1059,7 +1182,7 @@ def reconstruct_task_on_date(cur, task_id, working_date, scope_prefix, DEBUG,
     # Reduce the list of edges to only the single best match,
     # where best = earliest in the specified project list
     for project in project_id_list:
-        if project in edges:
+        if project in edge_set:
             best_edge = project
             break
 
@@ -1074,45 +1197,29 @@ def reconstruct_task_on_date(cur, task_id, working_date, scope_prefix, DEBUG,
         return
 
     pretty_project = project_id_to_name_dict[best_edge]
-    project_phid = project_name_to_phid_dict[pretty_project]
+    project_phid = project_name_to_phid_dict.get(pretty_project)
+    if project_phid is None:
+        if DEBUG:
+            print('Skipping task {0}: no phid for project {1}'.
+                  format(task_id, pretty_project))
+        return
 
     # ----------------------------------------------------------------------
     # Column
     # ----------------------------------------------------------------------
     pretty_column = ''
-    cur.execute("SELECT * FROM get_transaction_value(%s, %s, %s)",
-                (working_date, 'core:columns', task_id))
-    pc_trans_list = cur.fetchall()
     for pc_trans in pc_trans_list:
-        jblob = json.loads(pc_trans[0])[0]
+        jblob = parse_pc(pc_trans)
         if project_phid in jblob['boardPHID']:
             column_phid = jblob['columnPHID']
-            pretty_column = column_dict[column_phid]
+            pretty_column = column_dict.get(column_phid, '')
+            if DEBUG and not pretty_column:
+                print('Task {0}: unknown column {1}'.
+                      format(task_id, column_phid))
             break
 
-    denorm_insert = """
-        INSERT INTO task_on_date VALUES (
-        %(scope_prefix)s,
-        %(working_date)s,
-        %(id)s,
-        %(status)s,
-        %(project_id)s,
-        %(project)s,
-        %(projectcolumn)s,
-        %(points)s,
-        %(maint_type)s,
-        %(priority)s)"""
-
-    cur.execute(denorm_insert,
-                {'scope_prefix': scope_prefix,
-                 'working_date': working_date,
-                 'id': task_id,
-                 'status': pretty_status,
-                 'project_id': best_edge,
-                 'project': pretty_project,
-                 'projectcolumn': pretty_column,
-                 'points': pretty_points,
-                 'maint_type': maint_type,
-                 'priority': pretty_priority})
+    return (scope_prefix, working_date, task_id, pretty_status, best_edge,
+            pretty_project, pretty_column, pretty_points, maint_type,
+            pretty_priority)
 if __name__ == "__main__":
     main(sys.argv[1:])
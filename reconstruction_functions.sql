@@ -39,6 +39,24 @@ END;
 $$ LANGUAGE plpgsql;
 
 
+CREATE OR REPLACE FUNCTION build_edges_range(
+       start_date date,
+       end_date date,
+       project_id_list int array) RETURNS void AS $$
+DECLARE
+  run_date date;
+BEGIN
+
+    FOR run_date IN SELECT generate_series(start_date, end_date, '1 day')::date
+    LOOP
+        PERFORM build_edges(run_date, project_id_list);
+    END LOOP;
+
+    RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
+
 CREATE OR REPLACE FUNCTION get_descendents(
        root_id int,
        run_date date
@@ -68,23 +86,6 @@ END;
 $$ LANGUAGE plpgsql;
 
 
-CREATE OR REPLACE FUNCTION create_phab_parent_category_edges(
-       scope_prefix varchar(6),
-       working_date date,
-       category_id int
-) RETURNS void AS $$
-
-  INSERT INTO phab_parent_category_edge (
-  SELECT $1,
-         $2,
-         id,
-         $3
-    FROM (SELECT *
-            FROM get_descendents($3, $2)) as x)
-
-$$ LANGUAGE SQL VOLATILE;
-
-
 CREATE OR REPLACE FUNCTION fix_status(
        scope_prefix varchar(6)
 ) RETURNS void AS $$
@@ -117,9 +118,13 @@ CREATE OR REPLACE FUNCTION get_phab_parent_categories_by_day(
        category_tag_id int
 ) RETURNS TABLE(task int) AS $$
 
+  -- Only tasks already in the scope by working_date count, so the
+  -- result doesn't depend on how much of the range has been
+  -- reconstructed when it runs
   SELECT DISTINCT task
     FROM task_on_date t, maniphest_edge m
    WHERE t.scope = $1
+     AND t.date <= $2
      AND m.edge_date = $2
      AND t.id = m.task
      AND m.project = $3;
@@ -127,6 +132,27 @@ CREATE OR REPLACE FUNCTION get_phab_parent_categories_by_day(
 $$ LANGUAGE SQL STABLE;
 
 
+DROP FUNCTION IF EXISTS create_phab_parent_category_edges(varchar(6), date, int);
+
+CREATE OR REPLACE FUNCTION create_phab_parent_category_edges(
+       scope_prefix varchar(6),
+       start_date date,
+       end_date date,
+       category_tag_id int
+) RETURNS void AS $$
+
+  INSERT INTO phab_parent_category_edge (
+  SELECT $1,
+         d.working_date,
+         x.id,
+         c.task
+    FROM generate_series($2, $3, '1 day') AS d(working_date),
+         LATERAL get_phab_parent_categories_by_day($1, d.working_date::date, $4) AS c,
+         LATERAL get_descendents(c.task, d.working_date::date) AS x)
+
+$$ LANGUAGE SQL VOLATILE;
+
+
 CREATE OR REPLACE FUNCTION get_edge_value(
        working_date date,
        input_task_id int
@@ -181,6 +207,21 @@ CREATE OR REPLACE FUNCTION get_tasks(
 $$ LANGUAGE SQL STABLE;
 
 
+CREATE OR REPLACE FUNCTION get_tasks_range(
+       start_date date,
+       end_date date,
+       project_ids int[]
+) RETURNS TABLE(edge_date date, id int) AS $$
+
+  SELECT DISTINCT edge_date, task
+    FROM maniphest_edge
+   WHERE edge_date BETWEEN $1 AND $2
+     AND project = ANY($3)
+   ORDER BY edge_date, task;
+
+$$ LANGUAGE SQL STABLE;
+
+
 CREATE OR REPLACE FUNCTION get_transaction_value(
        working_date date,
        input_transaction_type text,
@@ -200,6 +241,25 @@ END;
 $$ LANGUAGE plpgsql;
 
 
+CREATE OR REPLACE FUNCTION get_task_values_on_date(
+       working_date date,
+       task_ids int[]
+) RETURNS TABLE(task_id int, story_points text, status text, priority text,
+                points text, active_projects int[], columns text[]) AS $$
+
+  SELECT t.id,
+         mt.story_points,
+         (SELECT v FROM get_transaction_value($1, 'status', t.id) AS v LIMIT 1),
+         (SELECT v FROM get_transaction_value($1, 'priority', t.id) AS v LIMIT 1),
+         (SELECT v FROM get_transaction_value($1, 'points', t.id) AS v LIMIT 1),
+         get_edge_value($1, t.id),
+         ARRAY(SELECT get_transaction_value($1, 'core:columns', t.id))
+    FROM unnest($2) AS t(id)
+         LEFT OUTER JOIN maniphest_task mt ON mt.id = t.id;
+
+$$ LANGUAGE SQL STABLE;
+
+
 CREATE OR REPLACE FUNCTION put_category_tasks_in_own_category(
        scope_prefix varchar(6),
        category_id int
@@ -838,6 +838,34 @@ CREATE OR REPLACE FUNCTION recategorize_by_intersection(
 $$ LANGUAGE SQL VOLATILE;
 
 
+CREATE OR REPLACE FUNCTION recategorize_all(
+    scope_prefix varchar(6)
+) RETURNS void as $$
+DECLARE
+  r record;
+BEGIN
+
+  FOR r IN SELECT * FROM get_category_rules(scope_prefix)
+  LOOP
+    CASE r.rule
+      WHEN 'ProjectByID' THEN
+        PERFORM recategorize_by_project(scope_prefix, r.project_id_list, r.title);
+      WHEN 'Intersection' THEN
+        PERFORM recategorize_by_intersection(scope_prefix, r.project_id_list, r.title);
+      WHEN 'ProjectColumn' THEN
+        PERFORM recategorize_by_column(scope_prefix, r.project_id_list, r.title, r.matchstring);
+      WHEN 'ParentTask' THEN
+        PERFORM recategorize_by_parenttask(scope_prefix, r.project_id_list, r.title, r.matchstring);
+      ELSE
+        RAISE EXCEPTION 'Invalid categorization rule %', r.rule;
+    END CASE;
+  END LOOP;
+
+  PERFORM purge_leftover_task_on_date(scope_prefix);
+END;
+$$ LANGUAGE plpgsql;
+
+
 CREATE OR REPLACE FUNCTION set_category_retroactive(
     scope_prefix varchar(6)
     ) RETURNS void AS $$